@@ -1,12 +1,18 @@
 from __future__ import annotations
 
+import io
 import os
+import shutil
 import tempfile
 import base64
-from typing import Dict
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import BinaryIO, Dict
 
 import streamlit as st
 from dotenv import load_dotenv
+from PIL import Image, ImageOps, UnidentifiedImageError
 from jamaibase import JamAI, types as t
 
 # ==============================
@@ -19,7 +25,20 @@ PAT = os.getenv("JAMAI_PAT")
 if not PROJECT_ID or not PAT:
     raise RuntimeError("JAMAI_PROJECT_ID or JAMAI_PAT missing in .env")
 
-client = JamAI(project_id=PROJECT_ID, token=PAT)
+
+@st.cache_resource(show_spinner=False)
+def get_client(project_id: str, pat: str) -> JamAI:
+    """Build the JamAI client once and reuse it across Streamlit reruns."""
+    return JamAI(project_id=project_id, token=pat)
+
+
+client = get_client(PROJECT_ID, PAT)
+
+
+@st.cache_resource(show_spinner=False)
+def get_executor() -> ThreadPoolExecutor:
+    """Shared worker pool for background uploads, reused across reruns."""
+    return ThreadPoolExecutor(max_workers=4)
 
 # ==============================
 # Table IDs
@@ -28,6 +47,27 @@ TABLE_DETECT = "1. Detect the Problem"
 TABLE_CLARIFY = "2. User Clarification"
 TABLE_FINAL = "3. Final Conclusion"
 
+# Output columns read back from each Action table
+OUTPUT_COLS = {
+    TABLE_DETECT: ("crop_type", "initial_guess", "confidence_level", "clarifying_question"),
+    TABLE_CLARIFY: ("cleaned_answer", "confidence_level"),
+    TABLE_FINAL: ("final_diagnosis", "cause", "treatment_steps", "prevention_tips"),
+}
+
+# Chunk size used when spooling uploads to disk
+COPY_CHUNK_SIZE = 1 << 16
+
+# Photos are downscaled to this long side (px) before upload
+MAX_IMAGE_SIDE = 1024
+JPEG_QUALITY = 85
+
+# Pillow refuses to open images over 2x this many pixels. The default
+# (~89 MP) rejects 200 MP phone photos, so allow up to 256 MP.
+Image.MAX_IMAGE_PIXELS = 128_000_000
+
+# Uploaded-image URIs remembered per session
+URI_CACHE_SIZE = 8
+
 # ==============================
 # Streamlit UI Settings
 # ==============================
@@ -43,7 +83,7 @@ st.title("🌾 CropCheckAI – Fruit & Crop Disease Assistant")
 # Custom CSS
 # ==============================
 
-st.markdown("""
+CUSTOM_CSS = """
 <style>
 #loading-overlay {
     position: fixed;
@@ -93,10 +133,7 @@ function showLoader(text){
     document.getElementById("loading-overlay").style.display = "flex";
 }
 </script>
-""", unsafe_allow_html=True)
 
-
-st.markdown("""
 <style>
 
     /* Placeholder image box */
@@ -146,7 +183,7 @@ st.markdown("""
 
     /* Mobile button styles */
     @media (max-width: 600px) {
-        .stButton>button {
+        .stButton>button, .stFormSubmitButton>button {
             width: 100% !important;
             padding-top: 1rem;
             padding-bottom: 1rem;
@@ -154,20 +191,63 @@ st.markdown("""
     }
 
 </style>
-""", unsafe_allow_html=True)
+"""
+
+st.markdown(CUSTOM_CSS, unsafe_allow_html=True)
 
 
 # ==============================
 # Helpers
 # ==============================
-def upload_streamlit_file(tmp_file):
-    suffix = os.path.splitext(tmp_file.name)[1]
+def shrink_image(raw: bytes, filename: str) -> tuple[BinaryIO, str]:
+    """Re-encode photos larger than MAX_IMAGE_SIDE as a smaller JPEG.
+
+    Small images are returned untouched. Downscaling is best-effort: if
+    Pillow cannot decode the image, the original bytes are uploaded.
+    Returns the stream to upload and its filename.
+    """
+    try:
+        with Image.open(io.BytesIO(raw)) as img:
+            if max(img.size) <= MAX_IMAGE_SIDE:
+                return io.BytesIO(raw), filename
+
+            # Resizing drops the palette of PA images, so expand them first
+            if img.mode == "PA":
+                img = img.convert("RGBA")
+
+            # Shrink before rotating: thumbnail() on the still-unloaded file
+            # lets libjpeg decode at reduced scale (draft mode). The bounding
+            # box is square, so rotating afterwards gives the same size.
+            img.thumbnail((MAX_IMAGE_SIDE, MAX_IMAGE_SIDE), Image.LANCZOS)
+            # Apply the EXIF rotation, which is lost on re-encode
+            img = ImageOps.exif_transpose(img)
+
+            # JPEG has no alpha: flatten transparent PNGs onto white, not black
+            if img.has_transparency_data:
+                rgba = img.convert("RGBA")
+                img = Image.new("RGB", rgba.size, "white")
+                img.paste(rgba, mask=rgba.getchannel("A"))
+
+            buf = io.BytesIO()
+            img.convert("RGB").save(buf, "JPEG", quality=JPEG_QUALITY, optimize=True)
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError):
+        return io.BytesIO(raw), filename
+
+    buf.seek(0)
+    return buf, os.path.splitext(filename)[0] + ".jpg"
+
+
+def upload_streamlit_file(raw: bytes, filename: str) -> str:
+    """Upload an image to JamAI and return its URI.
 
-    # Reset stream pointer (CRITICAL FIX)
-    tmp_file.seek(0)
+    Runs on a worker thread. Large photos are downscaled first. The SDK
+    only accepts a path, hence the temp file.
+    """
+    stream, filename = shrink_image(raw, filename)
+    suffix = os.path.splitext(filename)[1]
 
     with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as f:
-        f.write(tmp_file.read())
+        shutil.copyfileobj(stream, f, length=COPY_CHUNK_SIZE)
         temp_path = f.name
 
     try:
@@ -180,6 +260,26 @@ def upload_streamlit_file(tmp_file):
             pass
 
 
+def start_upload(raw: bytes, filename: str, image_hash: str) -> Future:
+    """Return a future for the image's URI, reusing earlier uploads.
+
+    `uri_cache` maps image hash -> upload future, most recent last, and is
+    kept to URI_CACHE_SIZE entries. Failed uploads are retried.
+    """
+    cache = st.session_state.uri_cache
+    future = cache.get(image_hash)
+
+    if future is None or (future.done() and future.exception()):
+        future = get_executor().submit(upload_streamlit_file, raw, filename)
+
+    cache[image_hash] = future
+    cache.move_to_end(image_hash)
+    while len(cache) > URI_CACHE_SIZE:
+        cache.popitem(last=False)
+
+    return future
+
+
 
 
 def run_action_row(table_id: str, data: Dict[str, str]) -> Dict[str, str]:
@@ -194,20 +294,41 @@ def run_action_row(table_id: str, data: Dict[str, str]) -> Dict[str, str]:
     )
 
     row = resp.rows[0]
-    out = {}
+    return {
+        name: getattr(row.columns.get(name), "text", "") or ""
+        for name in OUTPUT_COLS[table_id]
+    }
+
+
+@st.cache_data(ttl=3600, max_entries=256, show_spinner=False)
+def _cached_action(table_id: str, data_key: tuple, _data: Dict[str, str]) -> Dict[str, str]:
+    """Cached run_action_row. `_data` is not part of the cache key."""
+    return run_action_row(table_id, _data)
+
+
+def call_action_table(
+    table_id: str, data: Dict[str, str], image_hash: str | None = None
+) -> Dict[str, str]:
+    """Run an Action table, reusing the result for identical inputs.
 
-    for name, val in row.columns.items():
-        if hasattr(val, "text") and val.text:
-            out[name] = val.text
+    Each upload gets a new URI, so when `image_hash` is given it replaces
+    `user_image` in the cache key.
+    """
+    key = dict(data)
+    if image_hash:
+        key["user_image"] = image_hash
+    return _cached_action(table_id, tuple(sorted(key.items())), data)
 
-    return out
 
+@st.cache_data(max_entries=8, show_spinner=False)
+def _encode_preview(image_hash: str, _data: bytes) -> str:
+    """Base64-encode a preview image once per `image_hash`."""
+    return base64.b64encode(_data).decode()
 
-def show_image_in_box(uploaded_file):
+
+def show_image_in_box(raw: bytes, image_hash: str):
     """Embed image inside placeholder container using base64."""
-    uploaded_file.seek(0)
-    bytes_data = uploaded_file.read()
-    encoded = base64.b64encode(bytes_data).decode()
+    encoded = _encode_preview(image_hash, raw)
 
     st.markdown(
         f"""
@@ -222,24 +343,22 @@ def show_image_in_box(uploaded_file):
 # ==============================
 # Session State
 # ==============================
-if "step" not in st.session_state:
-    st.session_state.step = 1
-
-if "detect_out" not in st.session_state:
-    st.session_state.detect_out = None
-
-if "clarify_out" not in st.session_state:
-    st.session_state.clarify_out = None
+DEFAULT_STATE = {
+    "step": 1,
+    "detect_out": None,
+    "clarify_out": None,
+    "final_out": None,
+    "upload_id": None,
+    "upload_hash": None,
+}
 
-if "final_out" not in st.session_state:
-    st.session_state.final_out = None
+# uri_cache is left out of DEFAULT_STATE so it survives "Start over"
+if "_initialized" not in st.session_state:
+    st.session_state.update(DEFAULT_STATE, uri_cache=OrderedDict(), _initialized=True)
 
 
 def reset_all():
-    st.session_state.step = 1
-    st.session_state.detect_out = None
-    st.session_state.clarify_out = None
-    st.session_state.final_out = None
+    st.session_state.update(DEFAULT_STATE)
     st.rerun()
 
 
@@ -264,31 +383,51 @@ if st.session_state.step == 1:
     )
 
     if user_image:
-        st.markdown("### 📷 Image Preview")
-        show_image_in_box(user_image)
+        raw = user_image.getvalue()
 
-    st.subheader("Describe the symptoms")
-    user_desc = st.text_area(
-        "desc",
-        placeholder="Example: Brown spots on mango leaves, dark patches near fruit stem…",
-        label_visibility="collapsed",
-        height=180,
-    )
+        # Hash and start uploading as soon as an image is picked, so the
+        # upload overlaps with the user typing the description. The hash is
+        # the cache key for the preview and the detect call.
+        if st.session_state.upload_id != user_image.file_id:
+            st.session_state.upload_id = user_image.file_id
+            st.session_state.upload_hash = hashlib.sha256(raw).hexdigest()
+            start_upload(raw, user_image.name, st.session_state.upload_hash)
+
+        st.markdown("### 📷 Image Preview")
+        show_image_in_box(raw, st.session_state.upload_hash)
+
+    # The uploader stays outside the form so the preview and background
+    # upload start right away; typing the description only reruns on submit.
+    with st.form("step1", border=False):
+        st.subheader("Describe the symptoms")
+        user_desc = st.text_area(
+            "desc",
+            placeholder="Example: Brown spots on mango leaves, dark patches near fruit stem…",
+            label_visibility="collapsed",
+            height=180,
+        )
 
-    colA, colB, colC = st.columns([1, 2, 1])
-    with colB:
-        submitted = st.button("Analyze disease", type="primary", use_container_width=True)
+        colA, colB, colC = st.columns([1, 2, 1])
+        with colB:
+            submitted = st.form_submit_button(
+                "Analyze disease", type="primary", use_container_width=True
+            )
 
     if submitted:
         if not user_image or not user_desc:
             st.warning("Please upload an image AND describe the symptoms.")
         else:
             with st.spinner("Analyzing crop / fruit disease…"):
-                uri = upload_streamlit_file(user_image)
+                uri = start_upload(
+                    raw,
+                    user_image.name,
+                    st.session_state.upload_hash,
+                ).result()
 
-                detect_out = run_action_row(
+                detect_out = call_action_table(
                     TABLE_DETECT,
                     {"user_image": uri, "user_desc": user_desc},
+                    image_hash=st.session_state.upload_hash,
                 )
 
                 st.session_state.detect_out = detect_out
@@ -304,16 +443,20 @@ if st.session_state.step == 1:
 if st.session_state.step == 2:
 
     detect = st.session_state.detect_out
+    crop_type = detect["crop_type"]
+    initial_guess = detect["initial_guess"]
+    question = detect["clarifying_question"]
+    confidence = detect["confidence_level"] or "N/A"
 
     st.header("Step 2 – Confirm details about the disease")
 
     st.info(
-        f"**Crop type:** {detect.get('crop_type')}\n\n"
-        f"**Initial guess:** {detect.get('initial_guess')}\n\n"
-        f"**Confidence:** {detect.get('confidence_level', 'N/A')}"
+        f"**Crop type:** {crop_type}\n\n"
+        f"**Initial guess:** {initial_guess}\n\n"
+        f"**Confidence:** {confidence}"
     )
 
-    st.warning(detect.get("clarifying_question", "No clarifying question."))
+    st.warning(question or "No clarifying question.")
 
     user_answer = st.text_area(
         "Your answer:",
@@ -326,12 +469,12 @@ if st.session_state.step == 2:
         else:
             with st.spinner("Interpreting your answer…"):
 
-                clarify_out = run_action_row(
+                clarify_out = call_action_table(
                     TABLE_CLARIFY,
                     {
-                        "crop_type": detect.get("crop_type"),
-                        "initial_guess": detect.get("initial_guess"),
-                        "clarifying_question": detect.get("clarifying_question"),
+                        "crop_type": crop_type,
+                        "initial_guess": initial_guess,
+                        "clarifying_question": question,
                         "user_answer": user_answer,
                     },
                 )
@@ -355,31 +498,35 @@ if st.session_state.step == 3:
 
     with st.spinner("Preparing final diagnosis…"):
 
-        final_out = run_action_row(
+        final_out = call_action_table(
             TABLE_FINAL,
             {
-                "crop_type": detect.get("crop_type"),
-                "initial_guess": detect.get("initial_guess"),
-                "cleaned_answer": clarify.get("cleaned_answer"),
-                "confidence_level": clarify.get("confidence_level"),
+                "crop_type": detect["crop_type"],
+                "initial_guess": detect["initial_guess"],
+                "cleaned_answer": clarify["cleaned_answer"],
+                "confidence_level": clarify["confidence_level"],
             },
         )
 
         st.session_state.final_out = final_out
 
     final = st.session_state.final_out
+    diagnosis = final["final_diagnosis"]
+    cause = final["cause"]
+    treatment = final["treatment_steps"]
+    prevention = final["prevention_tips"]
 
     st.subheader("🌿 Final disease diagnosis")
-    st.success(final.get("final_diagnosis", ""))
+    st.success(diagnosis)
 
     st.subheader("🦠 Cause")
-    st.write(final.get("cause", ""))
+    st.write(cause)
 
     st.subheader("🧴 Treatment steps")
-    st.write(final.get("treatment_steps", ""))
+    st.write(treatment)
 
     st.subheader("🛡 Prevention tips")
-    st.write(final.get("prevention_tips", ""))
+    st.write(prevention)
 
     if st.button("Start a new case"):
         reset_all()